@@ -9,13 +9,16 @@ import struct
 import math
 import shutil
 import io
+import multiprocessing
 from PIL import Image
 from optparse import OptionParser
 
 BS = 64*1024
+TILE_SIZE_ESTIMATE = 32*1024
 
 class MapError(Exception):
     def __init__(self, value):
+        Exception.__init__(self, value)
         self.value = value
     def __str__(self):
         return repr(self.value)
@@ -95,21 +98,34 @@ def gdalinfo_rasterio(mapfile):
         raw_scale = (tran[1], tran[5])
         return (datum, size, upper_left, bottom_right, raw_scale, interp)
 
-def gdal_translate_shell(infile, outfile, jpeg_quality, x, y, tw, th, interp = None):
-    os.popen4('gdal_translate -of JPEG' + interp + '-co QUALITY=%u ' % (jpeg_quality) + '-srcwin %u %u %u %u ' % (x,y,tw,th) + infile + ' ' + outfile)[1].read()
+def gdal_read_shell(infile, tmpfile, x, y, tw, th, interp = None, out_size = None):
+    outsize = ''
+    if out_size:
+        outsize = '-outsize %u %u ' % out_size
+    os.popen4('gdal_translate -of PNM' + interp + '-srcwin %u %u %u %u ' % (x,y,tw,th) + outsize + infile + ' ' + tmpfile)[1].read()
+    img = Image.open(tmpfile)
+    return (img.tobytes(), len(img.getbands()))
 
-def gdal_translate_rasterio(infile, outfile, jpeg_quality, x, y, tw, th, interp = None):
+def gdal_read_rasterio(infile, tmpfile, x, y, tw, th, interp = None, out_size = None):
     with rasterio.open(infile) as src:
         bands = src.indexes
-        data = src.read(window=((y, y+th), (x, x+tw)))
+        window = ((y, y+th), (x, x+tw))
+        if out_size:
+            (tw, th) = out_size
+            data = src.read(window=window, out=numpy.empty((src.count, th, tw), dtype=src.dtypes[0]))
+        else:
+            data = src.read(window=window)
         if len(data)==1:
-            colormap = src.colormap(bands[0])
-            vec = numpy.vectorize(lambda z:colormap[z], otypes=[numpy.uint8]*4) 
-            tmp = vec(data[0])
-            bands = range(1, 4)
-            data = numpy.array(tmp[:3])
-    with rasterio.open(outfile, 'w', driver='JPEG', width=tw, height=th, count=len(data), dtype=numpy.uint8, quality=jpeg_quality) as dst:
-        dst.write(data, bands)
+            try:
+                colormap = src.colormap(bands[0])
+            except ValueError:
+                colormap = None
+            if colormap:
+                vec = numpy.vectorize(lambda z:colormap[z], otypes=[numpy.uint8]*4)
+                tmp = vec(data[0])
+                data = numpy.array(tmp[:3])
+    data = numpy.ascontiguousarray(data[:3].transpose(1, 2, 0), dtype=numpy.uint8)
+    return (data.tobytes(), data.shape[2])
 
 def progress(percent):
     sp = '%.1f%%' % (percent)
@@ -124,24 +140,257 @@ def progress(percent):
     if percent==100:
         sys.stderr.write('\n')
 
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except:
+    libc = None
+
+def libc_function(names, argtypes):
+    for name in names:
+        try:
+            func = getattr(libc, name)
+        except:
+            continue
+        func.restype = ctypes.c_ssize_t
+        func.argtypes = argtypes
+        return func
+    return None
+
+if libc:
+    libc_pwrite = libc_function(['pwrite64', 'pwrite'], [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int64])
+else:
+    libc_pwrite = None
+
+if libc and sys.platform.startswith('linux'):
+    libc_copy_file_range = libc_function(['copy_file_range'], [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint])
+    libc_sendfile = libc_function(['sendfile64', 'sendfile'], [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t])
+else:
+    libc_copy_file_range = None
+    libc_sendfile = None
+
+def libc_check(result):
+    if result<0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+def copy_file_range(src_fd, dst_fd, count, src_pos, dst_pos):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(src_fd, dst_fd, count, src_pos, dst_pos)
+    return libc_check(libc_copy_file_range(src_fd, ctypes.byref(ctypes.c_int64(src_pos)), dst_fd, ctypes.byref(ctypes.c_int64(dst_pos)), count, 0))
+
+def sendfile(dst_fd, src_fd, src_pos, count):
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(dst_fd, src_fd, src_pos, count)
+    return libc_check(libc_sendfile(dst_fd, src_fd, ctypes.byref(ctypes.c_int64(src_pos)), count))
+
+def pwrite(fd, data, pos):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, pos)
+    if libc_pwrite:
+        return libc_check(libc_pwrite(fd, data, len(data), pos))
+    os.lseek(fd, pos, 0)
+    return os.write(fd, data)
+
+def kernel_copy(src_fd, dst_fd, src_pos, dst_pos, size):
+    use_copy_file_range = hasattr(os, 'copy_file_range') or libc_copy_file_range!=None
+    use_sendfile = hasattr(os, 'sendfile') or libc_sendfile!=None
+    done = 0
+    while done<size:
+        count = min(size-done, 0x40000000)
+        if use_copy_file_range:
+            try:
+                copied = copy_file_range(src_fd, dst_fd, count, src_pos+done, dst_pos+done)
+            except OSError:
+                use_copy_file_range = False
+                continue
+        elif use_sendfile:
+            try:
+                os.lseek(dst_fd, dst_pos+done, 0)
+                copied = sendfile(dst_fd, src_fd, src_pos+done, count)
+            except OSError:
+                use_sendfile = False
+                continue
+        else:
+            break
+        if copied<=0:
+            break
+        done += copied
+    return done
+
+def copy_file_data(src, dst, size=None):
+    dst.flush()
+    src_pos = src.tell()
+    dst_pos = dst.tell()
+    if size==None:
+        size = os.fstat(src.fileno()).st_size-src_pos
+    done = kernel_copy(src.fileno(), dst.fileno(), src_pos, dst_pos, size)
+    src.seek(src_pos+done, 0)
+    dst.seek(dst_pos+done, 0)
+    while done<size:
+        data = src.read(min(size-done, BS))
+        if not data:
+            break
+        dst.write(data)
+        done += len(data)
+    return done
+
 try:
     import rasterio
     import numpy
     gdalinfo = gdalinfo_rasterio
-    gdal_translate = gdal_translate_rasterio
+    gdal_read = gdal_read_rasterio
 except:
     if os.path.isdir('gdal') and os.getenv('PATH'):
         os.environ['PATH'] += os.pathsep + os.path.join(os.getcwd(), 'gdal')
     try:
         import gdal
         gdalinfo = gdalinfo_gdal
-        gdal_translate = gdal_translate_shell
+        gdal_read = gdal_read_shell
     except:
         gdalinfo = gdalinfo_shell
-        gdal_translate = gdal_translate_shell
+        gdal_read = gdal_read_shell
+
+try:
+    import turbojpeg
+    import numpy
+    turbojpeg.TurboJPEG()
+except:
+    turbojpeg = None
+
+class jpegEncoder(object):
+    name = None
+    subsamplings = ['444', '422', '420']
+
+    def __init__(self, quality=75, subsampling=None, optimize=False, qtables=None):
+        if subsampling and subsampling not in self.subsamplings:
+            raise MapError('Unknown chroma subsampling "%s"' % (subsampling))
+        self.quality = quality
+        self.subsampling = subsampling
+        self.optimize = optimize
+        self.qtables = qtables
+
+    @staticmethod
+    def get_test_pattern():
+        pixels = []
+        for y in range(0, 256):
+            for x in range(0, 256):
+                pixels.append(chr(x) + chr(y) + chr((x+y)/2))
+        return ''.join(pixels)
+
+    @staticmethod
+    def get_jpeg_frame(data):
+        if data[:2]!='\xff\xd8':
+            return None
+        pos = 2
+        while pos+4<=len(data) and data[pos]=='\xff':
+            marker = ord(data[pos+1])
+            if marker>=0xc0 and marker<=0xcf and marker not in [0xc4, 0xc8, 0xcc]:
+                return marker
+            pos += 2 + struct.unpack('>H', data[pos+2:pos+4])[0]
+        return None
+
+    def self_test(self):
+        pattern = self.get_test_pattern()
+        try:
+            data = self.encode(pattern, 256, 256, 3)
+        except MapError:
+            raise
+        except Exception, e:
+            raise MapError('Encoder %s failed to encode test tile: %s' % (self.name, e))
+        frame = self.get_jpeg_frame(data)
+        if frame==None:
+            raise MapError('Encoder %s produced broken jpeg' % (self.name))
+        if frame!=0xc0:
+            raise MapError('Encoder %s produced non-baseline jpeg (SOF%u), device can not decode it' % (self.name, frame-0xc0))
+        try:
+            img = Image.open(io.BytesIO(data))
+            img.load()
+            decoded = img.convert('RGB').tobytes()
+        except Exception, e:
+            raise MapError('Encoder %s produced jpeg that can not be decoded: %s' % (self.name, e))
+        if img.size!=(256, 256):
+            raise MapError('Encoder %s produced jpeg of wrong size' % (self.name))
+        error = sum([abs(ord(pattern[i])-ord(decoded[i])) for i in range(0, len(pattern), 7)])/float(len(range(0, len(pattern), 7)))
+        if error>16:
+            raise MapError('Encoder %s produced jpeg with too large error %.1f' % (self.name, error))
+        return error
+
+    def benchmark(self, num_tiles=100):
+        pattern = self.get_test_pattern()
+        start = time.time()
+        for i in range(0, num_tiles):
+            self.encode(pattern, 256, 256, 3)
+        return num_tiles/max(time.time()-start, 1e-6)
+
+class pillowEncoder(jpegEncoder):
+    name = 'pillow'
+
+    def encode(self, pixels, width, height, bands):
+        mode = 'RGB'
+        if bands==1:
+            mode = 'L'
+        img = Image.frombuffer(mode, (width, height), pixels, 'raw', mode, 0, 1)
+        settings = {'quality': self.quality, 'optimize': self.optimize}
+        if self.subsampling:
+            settings['subsampling'] = self.subsamplings.index(self.subsampling)
+        if self.qtables:
+            settings['qtables'] = self.qtables
+        o_img = io.BytesIO()
+        img.save(o_img, 'JPEG', **settings)
+        return o_img.getvalue()
+
+class turbojpegEncoder(jpegEncoder):
+    name = 'turbojpeg'
+
+    def __init__(self, quality=75, subsampling=None, optimize=False, qtables=None):
+        if not turbojpeg:
+            raise MapError('Encoder turbojpeg requires PyTurboJPEG module and libjpeg-turbo')
+        if optimize or qtables:
+            raise MapError('Encoder turbojpeg does not support optimize and quantization tables settings')
+        jpegEncoder.__init__(self, quality, subsampling, optimize, qtables)
+        self.jpeg = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['jpeg'] = None
+        return state
+
+    def encode(self, pixels, width, height, bands):
+        if self.jpeg==None:
+            try:
+                self.jpeg = turbojpeg.TurboJPEG()
+            except:
+                raise MapError('Cant load libjpeg-turbo library')
+        data = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape((height, width, bands))
+        if bands==1:
+            return self.jpeg.encode(data, quality=self.quality, pixel_format=turbojpeg.TJPF_GRAY, jpeg_subsample=turbojpeg.TJSAMP_GRAY)
+        subsampling = {'444': turbojpeg.TJSAMP_444, '422': turbojpeg.TJSAMP_422, '420': turbojpeg.TJSAMP_420}[self.subsampling or '420']
+        return self.jpeg.encode(data, quality=self.quality, pixel_format=turbojpeg.TJPF_RGB, jpeg_subsample=subsampling)
+
+jpeg_encoders = [turbojpegEncoder, pillowEncoder]
+
+def get_jpeg_encoders():
+    encoders = []
+    for encoder in jpeg_encoders:
+        if encoder==turbojpegEncoder and not turbojpeg:
+            continue
+        encoders.append(encoder.name)
+    return encoders
+
+def get_jpeg_encoder(name='auto', **settings):
+    names = get_jpeg_encoders()
+    if name=='auto':
+        name = names[0]
+    for encoder in jpeg_encoders:
+        if encoder.name==name and name in names:
+            return encoder(**settings)
+    raise MapError('Jpeg encoder "%s" is not available' % (name))
 
 class mapFile(object):
-    def __init__(self, filename):
+    def __init__(self, filename, resolution=None):
         self.filename = filename
         try:
             info = gdalinfo(filename)
@@ -150,19 +399,59 @@ class mapFile(object):
         if info[0]!='WGS_1984':
             raise MapError('Map "%s" is not in WGS_1984 datum' % (filename))
         self.size = info[1]
+        self.src_size = info[1]
+        self.raw_scale = info[4]
+        self.src_factor = None
+        if resolution:
+            self.src_factor = (resolution[0]/abs(self.raw_scale[0]), resolution[1]/abs(self.raw_scale[1]))
+            self.raw_scale = (math.copysign(resolution[0], self.raw_scale[0]), math.copysign(resolution[1], self.raw_scale[1]))
+            self.size = (int(round(self.src_size[0]/self.src_factor[0])), int(round(self.src_size[1]/self.src_factor[1])))
         if self.size[0]<256 or self.size[1]<256:
             raise MapError('Map image "%s" should be larger than 256x256 pixels' % (filename))
         self.top_left = info[2]
         self.bottom_right = info[3]
-        self.raw_scale = info[4]
         self.scale = (self.raw_scale[0]*256, self.raw_scale[1]*256)
         self.interp = info[5]
         (self.first_tile, self.first_tile_coord) = self.get_first_tile()
         self.diff = self.get_tile_diff()
         self.size_in_tiles = self.get_size_in_tiles()
-        max_tiles = tlmFile().get_max_num_tiles()
-        self.num_topos = (self.size_in_tiles[0]*self.size_in_tiles[1]+max_tiles-1)/max_tiles
-        self.topo_len = max_tiles/self.size_in_tiles[1]
+        self.topos = self.get_topos(tlmFile().get_max_num_tiles())
+        self.num_topos = len(self.topos)
+
+    def get_source_window(self, x, y, w, h):
+        if not self.src_factor:
+            return (x, y, w, h)
+        sx = min(int(round(x*self.src_factor[0])), self.src_size[0]-1)
+        sy = min(int(round(y*self.src_factor[1])), self.src_size[1]-1)
+        sw = min(max(int(round((x+w)*self.src_factor[0])), sx+1), self.src_size[0])-sx
+        sh = min(max(int(round((y+h)*self.src_factor[1])), sy+1), self.src_size[1])-sy
+        return (sx, sy, sw, sh)
+
+    def get_topos(self, max_tiles):
+        (width, height) = self.size_in_tiles
+        best = None
+        th = None
+        for i in range(1, height+1):
+            if th==(height+i-1)/i:
+                continue
+            th = (height+i-1)/i
+            if th>max_tiles:
+                continue
+            tw = min(width, max_tiles/th)
+            cols = (width+tw-1)/tw
+            rows = (height+th-1)/th
+            tw = (width+cols-1)/cols
+            key = (cols*rows, max(tw, th)/float(min(tw, th)))
+            if best==None or key<best[0]:
+                best = (key, tw, th)
+            if cols==1:
+                break
+        (tw, th) = best[1:]
+        topos = []
+        for x in range(0, width, tw):
+            for y in range(0, height, th):
+                topos.append(((x, y), (min(width-x, tw), min(height-y, th))))
+        return topos
 
     def get_size_in_tiles(self):
         tilew = int(math.ceil((self.size[0]-self.diff[0])/float(256))+1)
@@ -229,6 +518,9 @@ class rmpAppender(object):
     def write(self, *data):
         self.fileio.write(*data)
 
+    def write_from_file(self, fileio, size=None):
+        return copy_file_data(fileio, self.fileio, size)
+
     def seek(self, pos, whence=0):
         if whence==0:
             self.fileio.seek(self.start+pos, 0)
@@ -249,7 +541,67 @@ class rmpAppender(object):
             self.rmpfile.rmpfile.write('\0')
             self.rmpfile.offset += 1
 
+class rmpRegion(object):
+    def __init__(self, filename, start, size):
+        self.filename = filename
+        self.start = start
+        self.size = size
+        self.pos = 0
+        self.fd = None
+
+    def open(self):
+        if self.fd==None:
+            try:
+                self.fd = os.open(self.filename, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            except:
+                raise MapError('Cant open rmp file "%s" for writing' % (self.filename))
+        return self.fd
+
+    def write(self, data):
+        if self.pos+len(data)>self.size:
+            raise MapError('Write beyond reserved region in rmp file "%s"' % (self.filename))
+        fd = self.open()
+        done = 0
+        while done<len(data):
+            done += pwrite(fd, data[done:], self.start+self.pos+done)
+        self.pos += done
+
+    def write_from_file(self, fileio, size=None):
+        src_pos = fileio.tell()
+        if size==None:
+            size = os.fstat(fileio.fileno()).st_size-src_pos
+        if self.pos+size>self.size:
+            raise MapError('Write beyond reserved region in rmp file "%s"' % (self.filename))
+        done = kernel_copy(fileio.fileno(), self.open(), src_pos, self.start+self.pos, size)
+        self.pos += done
+        fileio.seek(src_pos+done, 0)
+        while done<size:
+            data = fileio.read(min(size-done, BS))
+            if not data:
+                break
+            self.write(data)
+            done += len(data)
+        return done
+
+    def seek(self, pos, whence=0):
+        if whence==0:
+            self.pos = pos
+        elif whence==1:
+            self.pos += pos
+        elif whence==2:
+            self.pos = self.size+pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.fd!=None:
+            os.close(self.fd)
+            self.fd = None
+
 class rmpFile(object):
+    prealloc_files = 256
+
     def __init__(self, filename):
         self.filename = filename
         self.filename_tmp = self.filename + '.tmp'
@@ -260,7 +612,6 @@ class rmpFile(object):
         except:
             raise MapError('Cant open tmp rmp file "%s" for writing' % (self.filename_tmp))
         self.files = []
-        self.prealloc_files = 256
         self.header_len = 40+24*self.prealloc_files
         self.rmpfile.seek(self.header_len, 0)
         self.offset = 0
@@ -268,17 +619,23 @@ class rmpFile(object):
     def get_appender(self, filename):
         return rmpAppender(self, filename)
 
-    def append_from_file(self, targetname, sourcename):
+    def append_from_file(self, targetname, sourcename, offset=0, size=None):
         appender = self.get_appender(targetname)
         rfile = open(sourcename, 'rb')
-        while True:
-            data = rfile.read(BS)
-            appender.write(data)
-            if len(data)<BS:
-                break
+        rfile.seek(offset, 0)
+        appender.write_from_file(rfile, size)
         rfile.close()
         appender.close()
 
+    def reserve(self, targetname, size):
+        start = self.header_len+self.offset
+        self.files.append((targetname, self.offset, size))
+        self.offset += size+size%2
+        self.rmpfile.flush()
+        self.rmpfile.truncate(self.header_len+self.offset)
+        self.rmpfile.seek(self.header_len+self.offset, 0)
+        return rmpRegion(self.filename_tmp, start, size)
+
     def append_from_string(self, targetname, content):
         appender = self.get_appender(targetname)
         appender.write(content)
@@ -305,8 +662,7 @@ class rmpFile(object):
         self.rmpfile.write('\xe5\xe5MAGELLAN\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
         if len(self.files)>self.prealloc_files:
             rmpfile_old.seek(self.header_len, 0)
-            for i in range(0, (self.offset+BS-1)/BS):
-                self.rmpfile.write(rmpfile_old.read(BS))
+            copy_file_data(rmpfile_old, self.rmpfile, self.offset)
             rmpfile_old.close()
             os.unlink(self.filename_tmp)
             os.rename(self.filename_tmp+'2', self.filename_tmp)
@@ -316,11 +672,12 @@ class rmpFile(object):
         os.rename(self.filename_tmp, self.filename)
 
 class tlmFile(object):
-    def __init__(self, tlm=None, rmap=None, tiles_offset=None, tiles_size=None):
+    def __init__(self, tlm=None, rmap=None, tiles_offset=None, tiles_size=None, num_tiles=None):
         self.tlm = tlm
         self.rmap = rmap
         self.tiles_size = tiles_size
         self.tiles_offset = tiles_offset
+        self.num_tiles = num_tiles
         self.blocks_start = 0xf5c
         self.block_size = 0x7c8
         self.header_len = 0x100
@@ -336,7 +693,8 @@ class tlmFile(object):
         (self.top_left, self.bottom_right) = self.calc_corners()
 
     def calc_num_blocks(self):
-        self.num_tiles = self.tiles_size[0]*self.tiles_size[1]
+        if self.num_tiles==None:
+            self.num_tiles = self.tiles_size[0]*self.tiles_size[1]
         self.num_data_blocks = (self.num_tiles+self.real_tiles_per_block-1)/self.real_tiles_per_block
         if self.num_data_blocks>1:
             self.num_data_blocks += 1
@@ -442,8 +800,101 @@ class tlmFile(object):
         self.tlm.write('\0')
         self.tlm.close()
 
+class rmpReader(object):
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self.rmpfile = open(self.filename, 'rb')
+        except:
+            raise MapError('Cant open rmp file "%s" for reading' % (self.filename))
+        numfiles = struct.unpack('II', self.rmpfile.read(8))[0]
+        self.files = []
+        for i in range(0, numfiles):
+            metadata = self.rmpfile.read(24)
+            name = metadata[:9].rstrip('\0')
+            if metadata[9:16].rstrip('\0'):
+                name += '.' + metadata[9:16].rstrip('\0')
+            (offset, size) = struct.unpack('II', metadata[16:])
+            self.files.append((name, offset, size))
+        if self.rmpfile.read(40)[2:10]!='MAGELLAN':
+            raise MapError('Broken rmp file "%s"' % (self.filename))
+
+    def get_file(self, name):
+        for i in self.files:
+            if i[0].lower()==name.lower():
+                return i
+        raise MapError('No file "%s" in rmp file "%s"' % (name, self.filename))
+
+    def read_file(self, name):
+        (name, offset, size) = self.get_file(name)
+        self.rmpfile.seek(offset, 0)
+        return self.rmpfile.read(size)
+
+    def get_topos(self):
+        names = [i[0].lower() for i in self.files]
+        topos = []
+        for name in names:
+            m = re.search('^topo(\d+)\.tlm$', name)
+            if m and 'topo%s.a00' % (m.group(1)) in names:
+                topos.append(int(m.group(1)))
+        return sorted(topos)
+
+    def get_tlm(self, idx):
+        return tlmReader(self.read_file('topo%u.tlm' % (idx)))
+
+    def close(self):
+        self.rmpfile.close()
+
+class tlmReader(object):
+    def __init__(self, data):
+        self.header_len = 0x100
+        self.num_tiles = struct.unpack('I', data[4:8])[0]
+        scale = struct.unpack('dd', data[0x10:0x20])
+        self.scale = (scale[1], scale[0])
+        self.top_left = struct.unpack('dd', data[0x20:0x30])
+        self.bottom_right = struct.unpack('dd', data[0x30:0x40])
+        (self.tiles_per_block, first_block_offset) = struct.unpack('II', data[0x104:0x10c])
+        self.tiles = self.read_blocks(data, first_block_offset)
+        if len(self.tiles)!=self.num_tiles:
+            raise MapError('TLM file index has %u tiles instead of %u' % (len(self.tiles), self.num_tiles))
+
+    def read_blocks(self, data, first_block_offset):
+        tiles = []
+        done = set()
+        blocks = [first_block_offset]
+        while blocks:
+            offset = blocks.pop()
+            if offset in done or offset+self.header_len+8>len(data):
+                continue
+            done.add(offset)
+            pos = offset + self.header_len
+            (total, num, leaf) = struct.unpack('IHH', data[pos:pos+8])
+            for i in range(0, min(num, self.tiles_per_block)):
+                (x, y, tmp, addr) = struct.unpack('IIII', data[pos+8+16*i:pos+24+16*i])
+                tiles.append((x, y, addr))
+            if leaf==0:
+                pos += 8 + 16*self.tiles_per_block
+                for i in range(0, min(num, self.tiles_per_block)+1):
+                    link = struct.unpack('I', data[pos+4*i:pos+4*i+4])[0]
+                    if link:
+                        blocks.append(link)
+        return sorted(tiles)
+
+    def get_tile_corner(self, x, y):
+        return (x*self.scale[0]-180, y*self.scale[1]-90)
+
+class tlmMap(object):
+    def __init__(self, scale, top_left, bottom_right, tiles):
+        self.scale = scale
+        self.top_left = top_left
+        self.bottom_right = bottom_right
+        xs = [i[0] for i in tiles]
+        ys = [i[1] for i in tiles]
+        self.first_tile = (min(xs), min(ys))
+        self.size_in_tiles = (max(xs)-self.first_tile[0]+1, max(ys)-self.first_tile[1]+1)
+
 class rmpConverter(object):
-    def __init__(self, outfile, map_name, map_group, map_prov, map_ver, map_contact, map_copyright, map_copyright_file, jpeg_quality = 75, show_progress = False, resdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bin_res')):
+    def __init__(self, outfile, map_name, map_group, map_prov, map_ver, map_contact, map_copyright, map_copyright_file, jpeg_quality = 75, show_progress = False, resdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bin_res'), volume_tiles = None, volume_size = None, jobs = 1, encoder = None):
         self.maps = []
         self.outfile = outfile
         self.map_name = map_name
@@ -454,11 +905,21 @@ class rmpConverter(object):
         self.map_copyright = map_copyright
         self.map_copyright_file = map_copyright_file
         self.jpeg_quality = jpeg_quality
+        self.encoder = encoder or get_jpeg_encoder(quality=jpeg_quality)
+        self.encoded = 0
+        self.encode_time = 0
         self.show_progress = show_progress
         self.resdir = resdir
-        self.temp_tile = self.outfile + '.tile0'
+        self.volume_tiles = volume_tiles
+        self.volume_size = volume_size
+        self.jobs = jobs
         self.idx = 0
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['rmpfile'] = None
+        return state
+
     def add_map(self, rmap):
         self.maps.append(rmap)
 
@@ -488,11 +949,8 @@ class rmpConverter(object):
 
     def craft_ini_file(self):
         inifile = '[T_Layers]\r\n'
-        idx = 0
-        for i in range(0, len(self.maps)):
-            for j in range(0, self.maps[i].num_topos):
-                inifile += '%u=TOPO%u\r\n' % (idx, idx)
-                idx += 1
+        for idx in range(0, self.idx):
+            inifile += '%u=TOPO%u\r\n' % (idx, idx)
         inifile += '\0'
         self.rmpfile.append_from_string('rmp.ini', inifile)
 
@@ -518,47 +976,47 @@ class rmpConverter(object):
         return (x, w, pad)
 
     @staticmethod
-    def crop_image(img, tw, th, xpad, ypad):
+    def pad_tile(pixels, tw, th, bands, xpad, ypad):
         if xpad>=0:
-            xcrop = 0
+            (left, right) = ('', '\0'*(256-tw)*bands)
         else:
-            xcrop = 256 - tw
+            (left, right) = ('\0'*(256-tw)*bands, '')
+        row = tw*bands
+        rows = [left+pixels[i*row:(i+1)*row]+right for i in range(0, th)]
+        blank = ['\0'*256*bands]*(256-th)
         if ypad>=0:
-            ycrop = 0
+            rows = rows + blank
         else:
-            ycrop = 256 - th
-        img = Image.open(img)
-        new_img = Image.new("RGB", (256, 256))
-        new_img.paste(img, (xcrop, ycrop))
-        o_img = io.BytesIO()
-        new = new_img.save(o_img, 'JPEG')
-        return o_img.getvalue()
+            rows = blank + rows
+        return ''.join(rows)
 
-    def craft_tiles(self, rmap, idx, tiles_offset, tiles_size):
+    def craft_tiles(self, rmap, a00, tiles_offset, tiles_size):
         num_tiles = tiles_size[0]*tiles_size[1]
 
-        a00name = 'topo%u.a00' % (idx)
-        a00 = self.rmpfile.get_appender(a00name)
         a00.write(struct.pack('I', num_tiles))
         offsets = [4]
 
         for ix in range(tiles_offset[0], tiles_offset[0]+tiles_size[0]):
             if self.show_progress:
-                progress(100*ix/float(rmap.size_in_tiles[0]))
+                progress(100*self.done/float(self.num_tiles))
             for iy in range(tiles_offset[1], tiles_offset[1]+tiles_size[1]):
                 (x, tw, xpad) = self.get_tile_geometry(ix, rmap.diff[0], rmap.size[0])
                 (y, th, ypad) = self.get_tile_geometry(iy, rmap.diff[1], rmap.size[1])
-                gdal_translate(rmap.filename, self.temp_tile, self.jpeg_quality, x, y, tw, th, rmap.interp)
-                if xpad!=0 or ypad!=0:
-                    tile = self.crop_image(self.temp_tile, tw, th, xpad, ypad)
+                if rmap.src_factor:
+                    (pixels, bands) = gdal_read(rmap.filename, self.temp_tile, *rmap.get_source_window(x, y, tw, th), interp=rmap.interp, out_size=(tw, th))
                 else:
-                    tile = open(self.temp_tile, 'rb').read()
+                    (pixels, bands) = gdal_read(rmap.filename, self.temp_tile, x, y, tw, th, rmap.interp)
+                if xpad!=0 or ypad!=0:
+                    pixels = self.pad_tile(pixels, tw, th, bands, xpad, ypad)
+                start = time.time()
+                tile = self.encoder.encode(pixels, 256, 256, bands)
+                self.encode_time += time.time()-start
+                self.encoded += 1
                 a00.write(struct.pack('I', len(tile)))
                 a00.write(tile)
                 offsets.append(offsets[-1] + len(tile) + 4)
+            self.done += tiles_size[1]
         a00.close()
-        if self.show_progress and tiles_offset[0]+tiles_size[0]==rmap.size_in_tiles[0]:
-            progress(100)
         return offsets
 
     def craft_index(self, rmap, idx, offsets, tiles_offset, tiles_size):
@@ -576,27 +1034,290 @@ class rmpConverter(object):
 
         tlmfile.finish()
 
-    def run(self):
-        self.rmpfile = rmpFile(self.outfile)
-        self.craft_resourse_files()
-        self.craft_copyright_file()
+    def get_volume_tiles(self):
+        max_tiles = self.volume_tiles
+        if self.volume_size:
+            size_tiles = max(1, (self.volume_size-self.get_volume_size([], []))/TILE_SIZE_ESTIMATE)
+            topo_tiles = max([tiles_size[0]*tiles_size[1] for (rmap, tiles_offset, tiles_size) in self.get_topos(max_tiles)])
+            if topo_tiles>size_tiles:
+                max_tiles = size_tiles
+        return max_tiles
+
+    def get_topos(self, max_tiles=None):
+        topos = []
         for rmap in self.maps:
-            for topo in range(0, rmap.num_topos):
-                tiles_offset = (rmap.topo_len*topo, 0)
-                tiles_size = (min(rmap.size_in_tiles[0]-tiles_offset[0], rmap.topo_len), rmap.size_in_tiles[1])
-                offsets = self.craft_tiles(rmap, self.idx, tiles_offset, tiles_size)
-                self.craft_index(rmap, self.idx, offsets, tiles_offset, tiles_size)
-                self.idx += 1
-        self.craft_description_file()
-        self.craft_ini_file()
-        self.rmpfile.finish()
+            if max_tiles and max_tiles<tlmFile().get_max_num_tiles():
+                map_topos = rmap.get_topos(max_tiles)
+            else:
+                map_topos = rmap.topos
+            for (tiles_offset, tiles_size) in map_topos:
+                topos.append((rmap, tiles_offset, tiles_size))
+        return topos
+
+    def get_volumes(self):
+        volumes = [[]]
+        for topo in self.get_topos(self.get_volume_tiles()):
+            if volumes[-1] and not self.fits_volume(volumes[-1], topo):
+                volumes.append([])
+            volumes[-1].append(topo)
+        return volumes
+
+    def get_outfiles(self, num_volumes=None):
+        if num_volumes==None:
+            num_volumes = len(self.get_volumes())
+        return [self.get_outfile(i+1, num_volumes==1) for i in range(0, num_volumes)]
+
+    def get_existing_outfiles(self):
+        if not self.volume_size and not self.volume_tiles:
+            return [outfile for outfile in self.get_outfiles() if os.path.exists(outfile)]
+        (base, ext) = os.path.splitext(self.outfile)
+        outdir = os.path.dirname(base) or '.'
+        pattern = '^%s_\d+%s$' % (re.escape(os.path.basename(base)), re.escape(ext))
+        outfiles = [self.outfile] + [os.path.join(os.path.dirname(base), i) for i in sorted(os.listdir(outdir)) if re.search(pattern, i)]
+        return [outfile for outfile in outfiles if os.path.exists(outfile)]
+
+    def remove_temp_tile(self):
         try:
             os.unlink(self.temp_tile)
             if os.path.exists(self.temp_tile+'.aux.xml'):
                 os.unlink(self.temp_tile+'.aux.xml')
         except:
             pass
- 
+
+    def encode_topo(self, fragment, rmap, tiles_offset, tiles_size):
+        self.temp_tile = fragment + '.tile0'
+        self.done = 0
+        self.num_tiles = tiles_size[0]*tiles_size[1]
+        self.encoded = 0
+        self.encode_time = 0
+        try:
+            a00 = open(fragment, 'wb')
+        except:
+            raise MapError('Cant open tmp topo file "%s" for writing' % (fragment))
+        offsets = self.craft_tiles(rmap, a00, tiles_offset, tiles_size)
+        self.remove_temp_tile()
+        return offsets
+
+    def get_volume_size(self, topos, a00_sizes):
+        numfiles = 5+2*len(topos)
+        size = 40+24*max(rmpFile.prealloc_files, numfiles)
+        sizes = [os.path.getsize(os.path.join(self.resdir, i)) for i in ['bmp2bit.ics', 'bmp4bit.ics']]
+        if self.map_copyright_file:
+            sizes.append(os.path.getsize(self.map_copyright_file))
+        else:
+            sizes.append(len(self.map_copyright))
+        sizes.append(512+len(self.map_name+self.map_group+self.map_prov+self.map_ver+self.map_contact+self.map_copyright))
+        sizes.append(len('[T_Layers]\r\n')+sum([len('%u=TOPO%u\r\n' % (idx, idx)) for idx in range(0, len(topos))])+1)
+        for i in range(0, len(topos)):
+            tlm = tlmFile(num_tiles=topos[i][2][0]*topos[i][2][1])
+            tlm.calc_num_blocks()
+            sizes += [tlm.filesize, a00_sizes[i]]
+        return size+sum([i+i%2 for i in sizes])+len('MAGELLAN};')
+
+    def fits_volume(self, volume, topo, a00_sizes=None):
+        volume = volume+[topo]
+        if self.volume_tiles and sum([tiles_size[0]*tiles_size[1] for (rmap, tiles_offset, tiles_size) in volume])>self.volume_tiles:
+            return False
+        if self.volume_size and a00_sizes and self.get_volume_size(volume, a00_sizes)>self.volume_size:
+            return False
+        return True
+
+    def get_outfile(self, num, last):
+        if num==1 and last:
+            return self.outfile
+        (base, ext) = os.path.splitext(self.outfile)
+        return '%s_%u%s' % (base, num, ext)
+
+    def open_volume(self, num):
+        self.rmpfile = rmpFile(self.get_outfile(num, False))
+        self.craft_resourse_files()
+        self.craft_copyright_file()
+        return self.rmpfile
+
+    def place_topo(self, rmpfile, idx, topo, offsets):
+        (rmap, tiles_offset, tiles_size) = topo
+        self.rmpfile = rmpfile
+        region = rmpfile.reserve('topo%u.a00' % (idx), offsets[-1])
+        self.craft_index(rmap, idx, offsets, tiles_offset, tiles_size)
+        return region
+
+    def close_volume(self, rmpfile, num, last, num_topos):
+        self.rmpfile = rmpfile
+        self.idx = num_topos
+        self.craft_description_file()
+        self.craft_ini_file()
+        rmpfile.filename = self.get_outfile(num, last)
+        if os.path.exists(rmpfile.filename):
+            os.unlink(rmpfile.filename)
+        rmpfile.finish()
+        if self.volume_size and os.path.getsize(rmpfile.filename)>self.volume_size:
+            os.unlink(rmpfile.filename)
+            raise MapError('Volume "%s" is larger than split size of %u bytes, use -t/--split-tiles to make topo layers smaller' % (rmpfile.filename, self.volume_size))
+        return rmpfile.filename
+
+    def write_volumes(self, topos):
+        tasks = [(self, i, '%s.topo%u.a00' % (self.outfile, i)) + topos[i] for i in range(0, len(topos))]
+        order = sorted(tasks, key=lambda task: -task[5][0]*task[5][1])
+        num_tiles = sum([task[5][0]*task[5][1] for task in tasks])
+        done = 0
+        show_progress = self.show_progress
+        self.show_progress = False
+        pool = multiprocessing.Pool(min(self.jobs, len(tasks)))
+        writers = multiprocessing.Pool(min(self.jobs, len(tasks)))
+        volumes = volumeWriter(self, topos, writers)
+        try:
+            volumes.assign()
+            for (i, fragment, offsets, encoded, encode_time) in pool.imap_unordered(encode_topo, order):
+                self.encoded += encoded
+                self.encode_time += encode_time
+                done += len(offsets)-1
+                if show_progress:
+                    progress(100*done/float(num_tiles))
+                volumes.add_fragment(i, fragment, offsets)
+            volumes.close(True)
+            pool.close()
+            writers.close()
+        except:
+            pool.terminate()
+            writers.terminate()
+            pool.join()
+            writers.join()
+            for task in tasks:
+                if os.path.exists(task[2]):
+                    os.unlink(task[2])
+            volumes.abort()
+            raise
+        finally:
+            pool.join()
+            writers.join()
+            self.show_progress = show_progress
+        if show_progress and len(volumes.written)>1:
+            for outfile in volumes.written:
+                sys.stderr.write('Volume %s written\n' % (outfile))
+
+    def write_volume(self, outfile, topos):
+        self.rmpfile = rmpFile(outfile)
+        self.temp_tile = outfile + '.tile0'
+        self.idx = 0
+        self.done = 0
+        self.num_tiles = sum([tiles_size[0]*tiles_size[1] for (rmap, tiles_offset, tiles_size) in topos])
+        self.craft_resourse_files()
+        self.craft_copyright_file()
+        for (rmap, tiles_offset, tiles_size) in topos:
+            offsets = self.craft_tiles(rmap, self.rmpfile.get_appender('topo%u.a00' % (self.idx)), tiles_offset, tiles_size)
+            self.craft_index(rmap, self.idx, offsets, tiles_offset, tiles_size)
+            self.idx += 1
+        if self.show_progress:
+            progress(100)
+        self.craft_description_file()
+        self.craft_ini_file()
+        self.rmpfile.finish()
+        self.remove_temp_tile()
+
+    @staticmethod
+    def fill_region(region, fragment):
+        rfile = open(fragment, 'rb')
+        try:
+            if region.write_from_file(rfile)!=region.size:
+                raise MapError('Cant copy tmp topo file "%s" into rmp file "%s"' % (fragment, region.filename))
+        finally:
+            rfile.close()
+            region.close()
+        os.unlink(fragment)
+
+    def report_encoder(self):
+        sys.stderr.write('Encoded %u tiles with %s encoder in %.1fs (%.1f tiles/s per process)\n' % (self.encoded, self.encoder.name, self.encode_time, self.encoded/max(self.encode_time, 1e-6)))
+
+    def run(self):
+        topos = self.get_topos(self.get_volume_tiles())
+        if (self.jobs>1 and len(topos)>1) or self.volume_size:
+            self.write_volumes(topos)
+        else:
+            volumes = self.get_volumes()
+            outfiles = self.get_outfiles(len(volumes))
+            for i in range(0, len(volumes)):
+                self.write_volume(outfiles[i], volumes[i])
+        if self.show_progress:
+            self.report_encoder()
+
+class volumeWriter(object):
+    def __init__(self, converter, topos, writers):
+        self.converter = converter
+        self.topos = topos
+        self.writers = writers
+        self.fragments = [None]*len(topos)
+        self.assigned = [None]*len(topos)
+        self.volumes = [[]]
+        self.next_topo = 0
+        self.rmpfiles = {}
+        self.copies = {}
+        self.written = []
+
+    def add_fragment(self, i, fragment, offsets):
+        self.fragments[i] = (fragment, offsets)
+        if not self.converter.fits_volume([], self.topos[i], [offsets[-1]]):
+            raise MapError('Topo layer of %u tiles needs %u bytes, more than split size of %u bytes, use -t/--split-tiles to make topo layers smaller' % (len(offsets)-1, self.converter.get_volume_size([self.topos[i]], [offsets[-1]]), self.converter.volume_size))
+        if self.assigned[i]:
+            self.place(i)
+        self.assign()
+        self.close(False)
+
+    def assign(self):
+        while self.next_topo<len(self.topos) and (self.fragments[self.next_topo] or not self.converter.volume_size):
+            i = self.next_topo
+            volume = self.volumes[-1]
+            sizes = None
+            if self.fragments[i]:
+                sizes = [self.fragments[j][1][-1] for j in volume+[i]]
+            if volume and not self.converter.fits_volume([self.topos[j] for j in volume], self.topos[i], sizes):
+                self.volumes.append([])
+            self.assigned[i] = (len(self.volumes), len(self.volumes[-1]))
+            self.volumes[-1].append(i)
+            if self.fragments[i]:
+                self.place(i)
+            self.next_topo += 1
+
+    def place(self, i):
+        (num, idx) = self.assigned[i]
+        if num not in self.rmpfiles:
+            self.rmpfiles[num] = self.converter.open_volume(num)
+            self.copies[num] = []
+        (fragment, offsets) = self.fragments[i]
+        region = self.converter.place_topo(self.rmpfiles[num], idx, self.topos[i], offsets)
+        self.copies[num].append(self.writers.apply_async(fill_region, ((region, fragment),)))
+
+    def close(self, last):
+        for num in sorted(self.rmpfiles.keys()):
+            volume = self.volumes[num-1]
+            if num==len(self.volumes) and not last:
+                continue
+            if len(self.copies[num])<len(volume):
+                continue
+            if not last and [copy for copy in self.copies[num] if not copy.ready()]:
+                continue
+            for copy in self.copies[num]:
+                copy.get()
+            self.written.append(self.converter.close_volume(self.rmpfiles[num], num, last and len(self.volumes)==1, len(volume)))
+            del self.rmpfiles[num]
+
+    def abort(self):
+        for rmpfile in self.rmpfiles.values():
+            rmpfile.rmpfile.close()
+            if os.path.exists(rmpfile.filename_tmp):
+                os.unlink(rmpfile.filename_tmp)
+        for outfile in self.written:
+            if os.path.exists(outfile):
+                os.unlink(outfile)
+
+def encode_topo(args):
+    (converter, key, fragment, rmap, tiles_offset, tiles_size) = args
+    offsets = converter.encode_topo(fragment, rmap, tiles_offset, tiles_size)
+    return (key, fragment, offsets, converter.encoded, converter.encode_time)
+
+def fill_region(args):
+    (region, fragment) = args
+    rmpConverter.fill_region(region, fragment)
+
 if __name__=='__main__':
     usage = "usage: %prog [options] <input map1> [input map2] ..."
     parser = OptionParser(usage=usage)
@@ -609,22 +1330,61 @@ if __name__=='__main__':
     parser.add_option("-l", "--copyright", dest="copyright", help="map copyright [default: %default]", default='(C) Anonymous. License CC-BY-4.0.')
     parser.add_option("-f", "--copyright-file", dest="copyrightfile", help="map copyright text file [default: none]", default='')
     parser.add_option("-r", "--rewrite", dest="rewrite", action="store_true", help="rewrite destination file even if it exists", default=False)
+    parser.add_option("-s", "--split-size", dest="splitsize", type="int", help="split output into volumes of at most this many megabytes [default: no split]", default=0)
+    parser.add_option("-t", "--split-tiles", dest="splittiles", type="int", help="split output into volumes of at most this many tiles [default: no split]", default=0)
+    parser.add_option("--resolution", dest="resolution", help="output pixel size in degrees as <xres>[,<yres>], read from source overviews [default: source pixel size]")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help="number of topo layers encoded and volumes written in parallel, each layer needs temporary disk space until copied into its volume [default: %default]", default=multiprocessing.cpu_count())
+    parser.add_option("-q", "--quality", dest="quality", type="int", help="jpeg quality [default: %default]", default=75)
+    parser.add_option("-e", "--encoder", dest="encoder", type="choice", choices=['auto']+[i.name for i in jpeg_encoders], help="jpeg encoder, one of auto, %s [default: %%default]" % (', '.join([i.name for i in jpeg_encoders])), default='auto')
+    parser.add_option("--subsampling", dest="subsampling", type="choice", choices=jpegEncoder.subsamplings, help="jpeg chroma subsampling, one of %s [default: encoder default]" % (', '.join(jpegEncoder.subsamplings)))
+    parser.add_option("--optimize", dest="optimize", action="store_true", help="optimize jpeg huffman tables (pillow only)", default=False)
+    parser.add_option("--qtables", dest="qtables", help="jpeg quantization tables preset, e.g. web_high (pillow only)")
+    parser.add_option("--encoder-test", dest="encodertest", action="store_true", help="self-test and benchmark available jpeg encoders and exit", default=False)
     (options, args) = parser.parse_args()
+    settings = {'quality': options.quality, 'subsampling': options.subsampling, 'optimize': options.optimize, 'qtables': options.qtables}
+    if options.encodertest:
+        for name in get_jpeg_encoders():
+            try:
+                encoder = get_jpeg_encoder(name, **settings)
+                error = encoder.self_test()
+                sys.stderr.write('Encoder %s: self-test ok (mean error %.1f), %.1f tiles/s\n' % (name, error, encoder.benchmark()))
+            except MapError, e:
+                sys.stderr.write('%s\n' % (e.value))
+        sys.exit(0)
     if not options.rmpfile or len(args)<1:
         parser.print_usage()
         sys.exit(1)
-    if os.path.exists(options.rmpfile) and not options.rewrite:
-        sys.stderr.write('Destination rmp file "%s" already exists, use -r/--rewrite to overwrite\n' % (options.rmpfile))
-        sys.exit(2)
     if gdalinfo == gdalinfo_shell:
         sys.stderr.write('Using dgal binaries (Slow!)\n')
     elif gdalinfo == gdalinfo_gdal:
         sys.stderr.write('Using dgal module and binaries (Slow!)\n')
     elif gdalinfo == gdalinfo_rasterio:
         sys.stderr.write('Using rasterio module (Fast!)\n')
-    converter = rmpConverter(options.rmpfile, options.name, options.group, options.prov, options.version, options.contact, options.copyright, options.copyrightfile, show_progress=True)
+    try:
+        encoder = get_jpeg_encoder(options.encoder, **settings)
+        encoder.self_test()
+    except MapError, e:
+        sys.stderr.write('%s\n' % (e.value))
+        sys.exit(2)
+    sys.stderr.write('Using %s jpeg encoder\n' % (encoder.name))
+    converter = rmpConverter(options.rmpfile, options.name, options.group, options.prov, options.version, options.contact, options.copyright, options.copyrightfile, jpeg_quality=options.quality, show_progress=True, volume_tiles=options.splittiles, volume_size=options.splitsize*1024*1024, jobs=options.jobs, encoder=encoder)
+    resolution = None
+    if options.resolution:
+        try:
+            resolution = [float(i) for i in options.resolution.split(',')]
+            resolution = (resolution[0], resolution[-1])
+        except:
+            resolution = None
+        if len(options.resolution.split(','))>2 or not resolution or resolution[0]<=0 or resolution[1]<=0:
+            sys.stderr.write('Bad resolution "%s", should be <xres>[,<yres>] in degrees\n' % (options.resolution))
+            sys.exit(1)
     for mapfile in args:
-        rmap = mapFile(mapfile)
+        rmap = mapFile(mapfile, resolution)
         converter.add_map(rmap)
+    for outfile in converter.get_existing_outfiles():
+        if not options.rewrite:
+            sys.stderr.write('Destination rmp file "%s" already exists, use -r/--rewrite to overwrite\n' % (outfile))
+            sys.exit(2)
+        os.unlink(outfile)
     converter.run()
 
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+import sys
+import os
+import io
+import struct
+import tempfile
+import shutil
+import subprocess
+import multiprocessing
+from xml.sax.saxutils import escape
+from PIL import Image
+from optparse import OptionParser
+from geotiff2rmp import MapError, rmpReader, progress
+
+try:
+    import rasterio
+    import numpy
+    from rasterio.transform import from_origin
+except:
+    rasterio = None
+
+rmpfile = None
+
+def open_rmp(filename):
+    global rmpfile
+    rmpfile = open(filename, 'rb')
+
+def decode_tile(offset):
+    rmpfile.seek(offset, 0)
+    size = struct.unpack('I', rmpfile.read(4))[0]
+    data = rmpfile.read(size)
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    return (img.size, img.tobytes())
+
+def probe_tile(offset):
+    rmpfile.seek(offset, 0)
+    size = struct.unpack('I', rmpfile.read(4))[0]
+    img = Image.open(io.BytesIO(rmpfile.read(size)))
+    return (size, img.size, len(img.getbands()))
+
+class rmpExporter(object):
+    def __init__(self, infile, outfile, out_format='GTiff', topos=None, jobs=1, show_progress=False):
+        self.infile = infile
+        self.outfile = outfile
+        self.out_format = out_format
+        self.topos = topos
+        self.jobs = jobs
+        self.show_progress = show_progress
+        self.batch = max(1, jobs)*32
+
+    def get_topos(self, rmp):
+        topos = []
+        for idx in rmp.get_topos():
+            if self.topos and idx not in self.topos:
+                continue
+            topos.append((idx, rmp.get_tlm(idx)))
+        if not topos:
+            raise MapError('No topo layers to export in rmp file "%s"' % (self.infile))
+        scale = min([tlm.scale for (idx, tlm) in topos])
+        for (idx, tlm) in topos:
+            if tlm.scale!=scale:
+                sys.stderr.write('Skipping topo%u with different scale\n' % (idx))
+        return [(idx, tlm) for (idx, tlm) in topos if tlm.scale==scale]
+
+    @staticmethod
+    def get_tile_range(topos):
+        first_tile = (min([min([i[0] for i in tlm.tiles]) for (idx, tlm) in topos]), min([min([i[1] for i in tlm.tiles]) for (idx, tlm) in topos]))
+        last_tile = (max([max([i[0] for i in tlm.tiles]) for (idx, tlm) in topos]), max([max([i[1] for i in tlm.tiles]) for (idx, tlm) in topos]))
+        return (first_tile, last_tile)
+
+    def get_layout(self, rmp):
+        topos = [(idx, tlm) for (idx, tlm) in self.get_topos(rmp) if tlm.tiles]
+        if not topos:
+            raise MapError('No tiles to export in rmp file "%s"' % (self.infile))
+        (first_tile, last_tile) = self.get_tile_range(topos)
+        top_left = topos[0][1].get_tile_corner(*first_tile)
+        scale = topos[0][1].scale
+        res = (scale[0]/256, scale[1]/256)
+        size = ((last_tile[0]-first_tile[0]+1)*256, (last_tile[1]-first_tile[1]+1)*256)
+        return (topos, first_tile, top_left, res, size)
+
+    def write_geotiff(self, outfile):
+        if not rasterio:
+            raise MapError('Export to GeoTIFF requires rasterio module')
+        rmp = rmpReader(self.infile)
+        (topos, first_tile, top_left, res, (width, height)) = self.get_layout(rmp)
+        num_tiles = sum([len(tlm.tiles) for (idx, tlm) in topos])
+        transform = from_origin(top_left[0], -top_left[1], res[0], res[1])
+        pool = multiprocessing.Pool(self.jobs, open_rmp, (self.infile,))
+        try:
+            with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True), rasterio.open(outfile, 'w', driver='GTiff', width=width, height=height, count=3, dtype=numpy.uint8, crs='EPSG:4326', transform=transform, tiled=True, blockxsize=256, blockysize=256, compress='deflate', bigtiff='if_safer') as dst:
+                done = 0
+                for (idx, tlm) in topos:
+                    a00_offset = rmp.get_file('topo%u.a00' % (idx))[1]
+                    valid = self.get_valid_window(tlm, top_left, res)
+                    for i in range(0, len(tlm.tiles), self.batch):
+                        tiles = tlm.tiles[i:i+self.batch]
+                        decoded = pool.map(decode_tile, [a00_offset+addr for (x, y, addr) in tiles])
+                        for j in range(0, len(tiles)):
+                            px = (tiles[j][0]-first_tile[0])*256
+                            py = (tiles[j][1]-first_tile[1])*256
+                            self.write_tile(dst, decoded[j], px, py, width, height, valid)
+                        done += len(tiles)
+                        if self.show_progress:
+                            progress(100*done/float(num_tiles))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            rmp.close()
+
+    @staticmethod
+    def get_valid_window(tlm, top_left, res):
+        x0 = int(round((tlm.top_left[0]-top_left[0])/res[0]))
+        y0 = int(round((tlm.top_left[1]-top_left[1])/res[1]))
+        x1 = int(round((tlm.bottom_right[0]-top_left[0])/res[0]))
+        y1 = int(round((tlm.bottom_right[1]-top_left[1])/res[1]))
+        return (x0, y0, x1, y1)
+
+    @staticmethod
+    def write_tile(dst, tile, px, py, width, height, valid):
+        ((tw, th), data) = tile
+        data = numpy.frombuffer(data, dtype=numpy.uint8).reshape((th, tw, 3)).transpose(2, 0, 1)
+        (x0, y0) = (max(px, 0), max(py, 0))
+        (x1, y1) = (min(px+tw, width), min(py+th, height))
+        if x0>=x1 or y0>=y1:
+            return
+        data = data[:, y0-py:y1-py, x0-px:x1-px]
+        dst.write(data, window=((y0, y1), (x0, x1)))
+        mask = numpy.zeros((y1-y0, x1-x0), dtype=numpy.uint8)
+        (mx0, my0) = (max(valid[0], x0), max(valid[1], y0))
+        (mx1, my1) = (min(valid[2], x1), min(valid[3], y1))
+        if mx0<mx1 and my0<my1:
+            mask[my0-y0:my1-y0, mx0-x0:mx1-x0] = 255
+        dst.write_mask(mask, window=((y0, y1), (x0, x1)))
+
+    @staticmethod
+    def get_vrt_source(filename, band, src, dst, mask=False):
+        source = '<SourceFilename relativeToVRT="0">%s</SourceFilename><SourceBand>%u</SourceBand>' % (escape(filename), band)
+        source += '<SrcRect xOff="%u" yOff="%u" xSize="%u" ySize="%u"/>' % src
+        source += '<DstRect xOff="%u" yOff="%u" xSize="%u" ySize="%u"/>' % dst
+        if mask:
+            return '<ComplexSource>%s<ScaleOffset>255</ScaleOffset><ScaleRatio>0</ScaleRatio></ComplexSource>\n' % (source)
+        return '<SimpleSource>%s</SimpleSource>\n' % (source)
+
+    def write_vrt(self, outfile):
+        rmp = rmpReader(self.infile)
+        (topos, first_tile, top_left, res, (width, height)) = self.get_layout(rmp)
+        num_tiles = sum([len(tlm.tiles) for (idx, tlm) in topos])
+        infile = os.path.abspath(self.infile)
+        parts = [tempfile.TemporaryFile() for i in range(0, 4)]
+        pool = multiprocessing.Pool(self.jobs, open_rmp, (self.infile,))
+        try:
+            done = 0
+            for (idx, tlm) in topos:
+                a00_offset = rmp.get_file('topo%u.a00' % (idx))[1]
+                valid = self.get_valid_window(tlm, top_left, res)
+                for i in range(0, len(tlm.tiles), self.batch):
+                    tiles = tlm.tiles[i:i+self.batch]
+                    probed = pool.map(probe_tile, [a00_offset+addr for (x, y, addr) in tiles])
+                    for j in range(0, len(tiles)):
+                        (size, (tw, th), bands) = probed[j]
+                        px = (tiles[j][0]-first_tile[0])*256
+                        py = (tiles[j][1]-first_tile[1])*256
+                        (x0, y0) = (max(px, valid[0], 0), max(py, valid[1], 0))
+                        (x1, y1) = (min(px+tw, valid[2], width), min(py+th, valid[3], height))
+                        if x0>=x1 or y0>=y1:
+                            continue
+                        filename = '/vsisubfile/%u_%u,%s' % (a00_offset+tiles[j][2]+4, size, infile)
+                        src = (x0-px, y0-py, x1-x0, y1-y0)
+                        dst = (x0, y0, x1-x0, y1-y0)
+                        for band in range(0, 3):
+                            parts[band].write(self.get_vrt_source(filename, min(band+1, bands), src, dst))
+                        parts[3].write(self.get_vrt_source(filename, 1, src, dst, True))
+                    done += len(tiles)
+                    if self.show_progress:
+                        progress(100*done/float(num_tiles))
+            pool.close()
+            vrt = open(outfile, 'wb')
+            vrt.write('<VRTDataset rasterXSize="%u" rasterYSize="%u">\n' % (width, height))
+            vrt.write('<SRS>EPSG:4326</SRS>\n')
+            vrt.write('<GeoTransform>%.17g, %.17g, 0, %.17g, 0, %.17g</GeoTransform>\n' % (top_left[0], res[0], -top_left[1], -res[1]))
+            for band in range(0, 3):
+                vrt.write('<VRTRasterBand dataType="Byte" band="%u"><ColorInterp>%s</ColorInterp>\n' % (band+1, ['Red', 'Green', 'Blue'][band]))
+                parts[band].seek(0, 0)
+                shutil.copyfileobj(parts[band], vrt)
+                vrt.write('</VRTRasterBand>\n')
+            vrt.write('<MaskBand><VRTRasterBand dataType="Byte">\n')
+            parts[3].seek(0, 0)
+            shutil.copyfileobj(parts[3], vrt)
+            vrt.write('</VRTRasterBand></MaskBand>\n')
+            vrt.write('</VRTDataset>\n')
+            vrt.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            for part in parts:
+                part.close()
+            rmp.close()
+
+    def write_mbtiles(self):
+        (fd, tmpfile) = tempfile.mkstemp(suffix='.vrt', dir=os.path.dirname(os.path.abspath(self.outfile)))
+        os.close(fd)
+        try:
+            self.write_vrt(tmpfile)
+            if os.path.exists(self.outfile):
+                os.unlink(self.outfile)
+            if subprocess.call(['gdalwarp', '-q', '-t_srs', 'EPSG:3857', '-r', 'bilinear', '-dstalpha', '-of', 'MBTiles', tmpfile, self.outfile])!=0:
+                raise MapError('gdalwarp failed to write MBTiles file "%s"' % (self.outfile))
+            if subprocess.call(['gdaladdo', '-q', '-r', 'average', self.outfile, '2', '4', '8', '16'])!=0:
+                raise MapError('gdaladdo failed to build MBTiles overviews in "%s"' % (self.outfile))
+        finally:
+            os.unlink(tmpfile)
+
+    def run(self):
+        if self.out_format=='MBTiles':
+            self.write_mbtiles()
+        else:
+            self.write_geotiff(self.outfile)
+
+if __name__=='__main__':
+    usage = "usage: %prog [options] <input rmp>"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-o", "--outfile", dest="outfile", help="write result to GeoTIFF or MBTiles file")
+    parser.add_option("-F", "--format", dest="format", type="choice", choices=['GTiff', 'MBTiles'], help="output format, GTiff or MBTiles [default: guess from output file name]")
+    parser.add_option("-t", "--topo", dest="topos", type="int", action="append", help="export only this topo layer, may be repeated [default: all]")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help="number of tile decoding workers [default: %default]", default=multiprocessing.cpu_count())
+    parser.add_option("-r", "--rewrite", dest="rewrite", action="store_true", help="rewrite destination file even if it exists", default=False)
+    (options, args) = parser.parse_args()
+    if not options.outfile or len(args)!=1:
+        parser.print_usage()
+        sys.exit(1)
+    if os.path.exists(options.outfile) and not options.rewrite:
+        sys.stderr.write('Destination file "%s" already exists, use -r/--rewrite to overwrite\n' % (options.outfile))
+        sys.exit(2)
+    out_format = options.format
+    if not out_format:
+        if options.outfile.lower().endswith('.mbtiles'):
+            out_format = 'MBTiles'
+        else:
+            out_format = 'GTiff'
+    exporter = rmpExporter(args[0], options.outfile, out_format, options.topos, options.jobs, show_progress=True)
+    try:
+        exporter.run()
+    except MapError, e:
+        sys.stderr.write('%s\n' % (e.value))
+        sys.exit(-1)
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+import sys
+import os
+import io
+import re
+import struct
+import multiprocessing
+from PIL import Image
+from optparse import OptionParser
+from geotiff2rmp import MapError, rmpReader, rmpFile, tlmFile, tlmMap, progress, jpegEncoder, jpeg_encoders, get_jpeg_encoder
+
+def read_tile(rfile, offset):
+    rfile.seek(offset, 0)
+    size = struct.unpack('I', rfile.read(4))[0]
+    img = Image.open(io.BytesIO(rfile.read(size)))
+    if img.mode not in ['L', 'RGB']:
+        img = img.convert('RGB')
+    return img
+
+rmpfile = None
+
+def open_rmp(filename):
+    global rmpfile
+    rmpfile = open(filename, 'rb')
+
+def transcode_tile(args):
+    (parts, encoder, downsample) = args
+    if downsample:
+        img = Image.new('RGB', (512, 512))
+        for (dx, dy, offset) in parts:
+            img.paste(read_tile(rmpfile, offset).convert('RGB'), (dx*256, dy*256))
+        img = img.resize((256, 256), Image.ANTIALIAS)
+    else:
+        img = read_tile(rmpfile, parts[0][2])
+    return encoder.encode(img.tobytes(), img.size[0], img.size[1], len(img.getbands()))
+
+class rmpTranscoder(object):
+    def __init__(self, infile, outfile, jpeg_quality=75, downsample=False, jobs=1, show_progress=False, encoder=None):
+        self.infile = infile
+        self.outfile = outfile
+        self.jpeg_quality = jpeg_quality
+        self.encoder = encoder or get_jpeg_encoder(quality=jpeg_quality)
+        self.downsample = downsample
+        self.jobs = jobs
+        self.show_progress = show_progress
+        self.batch = max(1, jobs)*32
+
+    def get_tiles(self, topos):
+        groups = {}
+        for idx in topos:
+            tlm = self.tlms[idx]
+            a00_offset = self.rmp.get_file('topo%u.a00' % (idx))[1]
+            for (x, y, addr) in tlm.tiles:
+                if self.downsample:
+                    key = (tlm.scale, x/2, y/2)
+                    part = (x%2, y%2, a00_offset+addr)
+                else:
+                    key = (idx, x, y)
+                    part = (0, 0, a00_offset+addr)
+                groups.setdefault(key, []).append((idx, part))
+        tiles = dict([(idx, []) for idx in topos])
+        sources = dict([(idx, set()) for idx in topos])
+        for (key, parts) in groups.items():
+            idxs = [i for (i, part) in parts]
+            owner = min(set(idxs), key=lambda i: (-idxs.count(i), i))
+            tiles[owner].append(((key[1], key[2]), [part for (i, part) in parts]))
+            sources[owner].update(idxs)
+        for idx in topos:
+            tiles[idx].sort()
+        return (tiles, sources)
+
+    def get_corners(self, idx, tiles, scale):
+        tlm = self.tlms[idx]
+        if not self.downsample:
+            return (tlm.top_left, tlm.bottom_right)
+        sources = [self.tlms[i] for i in self.sources[idx]]
+        top_left = (min([i.top_left[0] for i in sources]), min([i.top_left[1] for i in sources]))
+        bottom_right = (max([i.bottom_right[0] for i in sources]), max([i.bottom_right[1] for i in sources]))
+        xs = [key[0] for (key, parts) in tiles]
+        ys = [key[1] for (key, parts) in tiles]
+        top_left = (max(top_left[0], min(xs)*scale[0]-180), max(top_left[1], min(ys)*scale[1]-90))
+        bottom_right = (min(bottom_right[0], (max(xs)+1)*scale[0]-180), min(bottom_right[1], (max(ys)+1)*scale[1]-90))
+        return (top_left, bottom_right)
+
+    def transcode_topo(self, pool, idx, new_idx):
+        tiles = self.tiles[idx]
+        scale = self.tlms[idx].scale
+        if self.downsample:
+            scale = (scale[0]*2, scale[1]*2)
+        for (key, parts) in tiles:
+            if (scale, key) in self.written:
+                raise MapError('Tile %u,%u of topo%u is already written to another topo' % (key[0], key[1], idx))
+            self.written.add((scale, key))
+
+        a00 = self.rmpfile.get_appender('topo%u.a00' % (new_idx))
+        a00.write(struct.pack('I', len(tiles)))
+        offsets = [4]
+        for i in range(0, len(tiles), self.batch):
+            batch = tiles[i:i+self.batch]
+            for tile in pool.map(transcode_tile, [(parts, self.encoder, self.downsample) for (key, parts) in batch]):
+                a00.write(struct.pack('I', len(tile)))
+                a00.write(tile)
+                offsets.append(offsets[-1] + len(tile) + 4)
+            self.done += sum([len(parts) for (key, parts) in batch])
+            if self.show_progress:
+                progress(100*self.done/float(self.num_tiles))
+        a00.close()
+
+        (top_left, bottom_right) = self.get_corners(idx, tiles, scale)
+        rmap = tlmMap(scale, top_left, bottom_right, [key for (key, parts) in tiles])
+        tlmfile = tlmFile(self.rmpfile.get_appender('topo%u.tlm' % (new_idx)), rmap, (0, 0), rmap.size_in_tiles, len(tiles))
+        tlmfile.write_header()
+        for i in range(0, len(tiles)):
+            tlmfile.add_tile(tiles[i][0][0], tiles[i][0][1], offsets[i])
+        tlmfile.finish()
+
+    def run(self):
+        self.rmp = rmpReader(self.infile)
+        topos = self.rmp.get_topos()
+        self.tlms = dict([(idx, self.rmp.get_tlm(idx)) for idx in topos])
+        (self.tiles, self.sources) = self.get_tiles(topos)
+        self.written = set()
+        self.num_tiles = sum([tlm.num_tiles for tlm in self.tlms.values()])
+        self.done = 0
+        kept = [idx for idx in topos if self.tiles[idx]]
+        if len(kept)==len(topos):
+            new_idx = dict([(idx, idx) for idx in topos])
+        else:
+            new_idx = dict([(kept[i], i) for i in range(0, len(kept))])
+        self.rmpfile = rmpFile(self.outfile)
+        pool = multiprocessing.Pool(self.jobs, open_rmp, (self.infile,))
+        try:
+            for (name, offset, size) in self.rmp.files:
+                m = re.search('^topo(\d+)\.(tlm|a00)$', name.lower())
+                if m and int(m.group(1)) in topos:
+                    if m.group(2)=='a00' and int(m.group(1)) in new_idx:
+                        self.transcode_topo(pool, int(m.group(1)), new_idx[int(m.group(1))])
+                elif len(kept)!=len(topos) and name.lower()=='rmp.ini':
+                    self.rmpfile.append_from_string(name, '[T_Layers]\r\n' + ''.join(['%u=TOPO%u\r\n' % (i, i) for i in range(0, len(kept))]) + '\0')
+                elif len(kept)!=len(topos) and name.lower()=='cvg_map.msf':
+                    self.rmpfile.append_from_string(name, re.sub('MAP_COUNT = \d+', 'MAP_COUNT = %u' % (len(kept)), self.rmp.read_file(name)))
+                else:
+                    self.rmpfile.append_from_file(name, self.infile, offset, size)
+            self.rmpfile.finish()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.rmp.close()
+        if self.show_progress and self.done<self.num_tiles:
+            progress(100)
+
+if __name__=='__main__':
+    usage = "usage: %prog [options] <input rmp>"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-o", "--outfile", dest="rmpfile", help="write result to rmp file")
+    parser.add_option("-q", "--quality", dest="quality", type="int", help="jpeg quality of new tiles [default: %default]", default=75)
+    parser.add_option("-e", "--encoder", dest="encoder", type="choice", choices=['auto']+[i.name for i in jpeg_encoders], help="jpeg encoder, one of auto, %s [default: %%default]" % (', '.join([i.name for i in jpeg_encoders])), default='auto')
+    parser.add_option("--subsampling", dest="subsampling", type="choice", choices=jpegEncoder.subsamplings, help="jpeg chroma subsampling, one of %s [default: encoder default]" % (', '.join(jpegEncoder.subsamplings)))
+    parser.add_option("-d", "--downsample", dest="downsample", action="store_true", help="halve map resolution, joining 2x2 tiles into one", default=False)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help="number of tile encoding workers [default: %default]", default=multiprocessing.cpu_count())
+    parser.add_option("-r", "--rewrite", dest="rewrite", action="store_true", help="rewrite destination file even if it exists", default=False)
+    (options, args) = parser.parse_args()
+    if not options.rmpfile or len(args)!=1:
+        parser.print_usage()
+        sys.exit(1)
+    if os.path.abspath(options.rmpfile)==os.path.abspath(args[0]):
+        sys.stderr.write('Destination rmp file should differ from source rmp file\n')
+        sys.exit(2)
+    if os.path.exists(options.rmpfile) and not options.rewrite:
+        sys.stderr.write('Destination rmp file "%s" already exists, use -r/--rewrite to overwrite\n' % (options.rmpfile))
+        sys.exit(2)
+    try:
+        encoder = get_jpeg_encoder(options.encoder, quality=options.quality, subsampling=options.subsampling)
+        encoder.self_test()
+        transcoder = rmpTranscoder(args[0], options.rmpfile, options.quality, options.downsample, options.jobs, show_progress=True, encoder=encoder)
+        transcoder.run()
+    except MapError, e:
+        sys.stderr.write('%s\n' % (e.value))
+        sys.exit(-1)